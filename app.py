@@ -1,8 +1,31 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import orjson
+import gzip
+import hmac
 import os
+import re
+import threading
+import time
+
+# Optional: zstd compression for large responses; gzip is used when it isn't installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class OrjsonProvider(JSONProvider):
+    """Serializes API responses with orjson instead of the stdlib json module."""
+    def dumps(self, obj, **kwargs):
+        # No key sorting or indentation: responses are consumed by machines
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__, static_folder="static")
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # ===== Configuration =====
@@ -10,10 +33,52 @@ API_TOKEN = "<your api token>"
 BASE_DIR = "./storage"
 COMMAND_DIR = os.path.join(BASE_DIR, "command")
 RESULT_DIR = os.path.join(BASE_DIR, "result")
+# Commands handed out by /claim_batch wait here until their results are finalized
+INFLIGHT_DIR = os.path.join(COMMAND_DIR, "inflight")
+
+# Paths served without authentication (dashboard UI and its static assets)
+PUBLIC_PREFIXES = ("/ui", "/static")
+
+# Full Authorization header value, built once instead of per request
+EXPECTED_AUTH = f"Bearer {API_TOKEN}".encode("utf-8")
+
+# Maximum time (seconds) a /wait_commands long-poll blocks before returning
+LONG_POLL_TIMEOUT = 30
+
+# Seconds a claimed command may stay inflight without being renewed (/renew) before
+# /claim_batch hands it out again (lost claim response, executor crash)
+INFLIGHT_LEASE = 60
+
+# Upper bound on the number of commands handed out by a single /claim_batch
+MAX_BATCH_SIZE = 256
+
+# Responses smaller than this (bytes) are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+
+# File suffixes recognized as commands
+COMMAND_SUFFIXES = (".yaml", ".json")
+
+# Signaled whenever a new command is saved, waking up long-polling executors
+command_event = threading.Event()
+
+# In-memory index of pending command names. The server is the only writer to COMMAND_DIR,
+# so the handlers below keep it current and listing/claiming never rescans the directory.
+command_index = set()
+command_index_lock = threading.Lock()
 
 # Ensure storage directories exist
 os.makedirs(COMMAND_DIR, exist_ok=True)
 os.makedirs(RESULT_DIR, exist_ok=True)
+os.makedirs(INFLIGHT_DIR, exist_ok=True)
+
+# Directory descriptors let handlers open files relative to their folder (openat) instead of
+# re-resolving and permission-checking the full path on every request.
+# Not available on Windows, which falls back to plain paths.
+USE_DIR_FD = {os.open, os.unlink, os.rename, os.utime} <= os.supports_dir_fd
+DIR_FDS = {
+    d: os.open(d, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)) if USE_DIR_FD else None
+    for d in (COMMAND_DIR, RESULT_DIR, INFLIGHT_DIR)
+}
 
 # ===== Helpers =====
 def get_target_dir(file_type):
@@ -24,41 +89,228 @@ def get_target_dir(file_type):
         return RESULT_DIR
     return None
 
+# A plain file name: no path separators or NUL, and no leading dot (rules out "..", hidden files)
+SAFE_FILENAME = re.compile(r"[^./\\\x00][^/\\\x00]*")
+
+def is_safe_filename(filename):
+    """Rejects names that could escape the storage folders (path separators, "..", hidden files)."""
+    return isinstance(filename, str) and SAFE_FILENAME.fullmatch(filename) is not None
+
+def resolve(directory, filename):
+    """Returns (path, dir_fd) for os calls on a file inside one of the storage folders."""
+    dir_fd = DIR_FDS.get(directory)
+    if dir_fd is None:
+        # Names are validated by is_safe_filename, so a plain concatenation is enough
+        return f"{directory}/{filename}", None
+    return filename, dir_fd
+
+def open_in(directory, filename, mode, **kwargs):
+    """Opens a file inside one of the storage folders, relative to its directory descriptor when available."""
+    path, dir_fd = resolve(directory, filename)
+    return open(path, mode, opener=lambda p, flags: os.open(p, flags, 0o666, dir_fd=dir_fd), **kwargs)
+
+def move_file(src_dir, dst_dir, filename, dst_name=None):
+    """Atomically moves a file between storage folders (os.replace)."""
+    src, src_fd = resolve(src_dir, filename)
+    dst, dst_fd = resolve(dst_dir, dst_name or filename)
+    os.replace(src, dst, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+
+def remove_file(directory, filename):
+    """Removes a file from a storage folder, ignoring files that are already gone."""
+    path, dir_fd = resolve(directory, filename)
+    try:
+        os.unlink(path, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+def list_queue_files(dir_path, suffixes=COMMAND_SUFFIXES):
+    """Returns the queued file names in a directory matching the given suffixes."""
+    # scandir reuses the d_type from readdir, so no extra stat() per entry
+    with os.scandir(dir_path) as it:
+        return [e.name for e in it if e.name.endswith(suffixes) and e.is_file(follow_symlinks=False)]
+
+def pending_commands():
+    """Returns the pending command names from the in-memory index, oldest first."""
+    # Task names embed a timestamp, so sorting puts the oldest commands first
+    with command_index_lock:
+        return sorted(command_index)
+
+def index_command(filename):
+    """Adds a command to the in-memory index once its file is fully written."""
+    if filename.endswith(COMMAND_SUFFIXES):
+        with command_index_lock:
+            command_index.add(filename)
+
+def unindex_command(filename):
+    """Removes a command from the in-memory index."""
+    with command_index_lock:
+        command_index.discard(filename)
+
+def renew_claim(filename):
+    """Restarts a claimed command's lease by stamping the current time as its mtime."""
+    path, dir_fd = resolve(INFLIGHT_DIR, filename)
+    os.utime(path, dir_fd=dir_fd)
+
+def claim_commands(limit):
+    """Moves up to `limit` pending commands into the inflight folder and returns their contents."""
+    claimed = []
+    for name in pending_commands()[:limit]:
+        try:
+            # os.replace is atomic, so each command is handed out exactly once
+            move_file(COMMAND_DIR, INFLIGHT_DIR, name)
+        except FileNotFoundError:
+            # Already claimed by a concurrent request
+            continue
+        finally:
+            unindex_command(name)
+        try:
+            # A rename keeps the old mtime, so stamp the claim time for the lease
+            renew_claim(name)
+            with open_in(INFLIGHT_DIR, name, "rb") as f:
+                content = f.read().decode("utf-8", errors="replace")
+        except OSError as e:
+            # Don't fail the whole batch: the command stays inflight and is retried when its lease expires
+            print(f"Failed to read claimed command {name}: {e}")
+            continue
+        claimed.append({"name": name, "content": content})
+    return claimed
+
+def finalize_command(filename, result=None):
+    """
+    Stores a claimed command's result (if any) as JSON and removes it from the inflight folder.
+    The result of "task_1.yaml" is saved as "task_1.json".
+    """
+    if result is not None:
+        result_name = os.path.splitext(filename)[0] + ".json"
+        # Write next to the target and rename, so readers never see a half-written result
+        tmp_name = f".{result_name}.tmp"
+        with open_in(RESULT_DIR, tmp_name, "wb") as f:
+            f.write(orjson.dumps(result))
+        move_file(RESULT_DIR, RESULT_DIR, tmp_name, result_name)
+    remove_file(INFLIGHT_DIR, filename)
+    # An expired lease may have put the command back in the queue meanwhile
+    remove_file(COMMAND_DIR, filename)
+    unindex_command(filename)
+
+def requeue_command(filename):
+    """Moves a claimed command back to the queue; returns False if it was finalized in the meantime."""
+    try:
+        move_file(INFLIGHT_DIR, COMMAND_DIR, filename)
+    except FileNotFoundError:
+        return False
+    index_command(filename)
+    return True
+
+def requeue_inflight(max_age=None):
+    """
+    Returns claimed commands that were never finalized to the queue.
+    With `max_age`, only commands claimed more than `max_age` seconds ago (expired leases) are requeued.
+    """
+    cutoff = None if max_age is None else time.time() - max_age
+    with os.scandir(INFLIGHT_DIR) as it:
+        entries = [e for e in it if e.name.endswith(COMMAND_SUFFIXES) and e.is_file(follow_symlinks=False)]
+    for entry in entries:
+        if cutoff is not None and entry.stat().st_mtime > cutoff:
+            continue
+        requeue_command(entry.name)
+
+requeue_inflight()
+command_index.update(list_queue_files(COMMAND_DIR))
+
 def verify_token(req):
-    """Simple Bearer Token authentication."""
-    return req.headers.get("Authorization") == f"Bearer {API_TOKEN}"
+    """Bearer Token authentication using a constant-time comparison."""
+    # Read the raw WSGI value (latin-1 decoded per PEP 3333) instead of going through the Headers wrapper
+    header = req.environ.get("HTTP_AUTHORIZATION", "")
+    return hmac.compare_digest(header.encode("latin-1"), EXPECTED_AUTH)
 
 @app.before_request
 def auth_middleware():
     """Middleware to check authentication for all non-UI endpoints."""
     # Skip authentication for UI and static assets
-    if request.path.startswith("/ui") or request.path.startswith("/static"):
+    if request.path.startswith(PUBLIC_PREFIXES):
         return
     
     if not verify_token(request):
         return jsonify({"success": False, "error": "Unauthorized access"}), 401
 
+@app.after_request
+def compress_response(response):
+    """Compresses large API responses (e.g. read_file) with zstd or gzip when the client accepts it."""
+    # Streamed files (send_file) stay uncompressed so they can still go out via sendfile()
+    if response.direct_passthrough or response.status_code != 200 or "Content-Encoding" in response.headers:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    # Parsed header: item lookups return the quality (0 when refused with q=0 or not listed)
+    accepted = request.accept_encodings
+    if zstandard and accepted["zstd"] > 0:
+        response.set_data(zstandard.ZstdCompressor(level=3).compress(data))
+        response.headers["Content-Encoding"] = "zstd"
+    elif accepted["gzip"] > 0:
+        # Level 1 keeps CPU cost low; source text still shrinks several times
+        response.set_data(gzip.compress(data, compresslevel=1))
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        return response
+    response.vary.add("Accept-Encoding")
+    return response
+
+def read_error(message, status, raw):
+    """Builds a read_file error; raw mode also sets an HTTP error status."""
+    # Raw clients can't tell an error envelope from file content, so they need the status code
+    body = jsonify({"success": False, "error": message})
+    return (body, status) if raw else body
+
 # ===== API Endpoints =====
 @app.route("/read_file")
 def read_file():
-    """Fetches content of a specific command or result file."""
+    """
+    Fetches content of a specific command or result file.
+    With `raw=1` the file itself is returned as text/plain instead of a JSON envelope.
+    """
     file_type = request.args.get("type")
     filename = request.args.get("filename")
+    raw = request.args.get("raw") == "1"
     
     directory = get_target_dir(file_type)
     if not directory:
-        return jsonify({"success": False, "error": "Invalid file type"})
-
-    file_path = os.path.join(directory, filename)
-    if not os.path.exists(file_path):
-        return jsonify({"success": False, "error": "File not found"})
+        return read_error("Invalid file type", 400, raw)
+    if not is_safe_filename(filename):
+        return read_error("Invalid filename", 400, raw)
 
+    # Open directly instead of checking os.path.exists first: one path lookup per request.
+    # The UI polls for results that don't exist yet, so the not-found path is the hot one.
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
+        if raw:
+            # send_file hands the open file to wsgi.file_wrapper, which servers like
+            # gunicorn/uWSGI/Waitress stream with sendfile() instead of copying through Python.
+            # The bytes go out untouched: no decode, JSON escape, or re-encode.
+            f = open_in(directory, filename, "rb")
+            try:
+                st = os.fstat(f.fileno())
+                response = send_file(
+                    f, mimetype="text/plain", conditional=True,
+                    last_modified=st.st_mtime, etag=f"{st.st_mtime_ns:x}-{st.st_size:x}"
+                )
+            except BaseException:
+                # Only the response closes the file, so close it ourselves if there is none
+                f.close()
+                raise
+            # send_file only knows the size of paths, not of open files
+            if response.status_code == 200:
+                response.content_length = st.st_size
+            return response
+
+        with open_in(directory, filename, "rb") as f:
+            content = f.read().decode("utf-8", errors="replace")
         return jsonify({"success": True, "content": content})
+    except FileNotFoundError:
+        return read_error("File not found", 404, raw)
     except Exception as e:
-        return jsonify({"success": False, "error": str(e)})
+        return read_error(str(e), 500, raw)
 
 
 @app.route("/save_file", methods=["POST"])
@@ -69,11 +321,15 @@ def save_file():
     
     if not directory:
         return jsonify({"success": False, "error": "Invalid directory type"})
+    if not is_safe_filename(data.get("filename")):
+        return jsonify({"success": False, "error": "Invalid filename"})
         
-    file_path = os.path.join(directory, data["filename"])
     try:
-        with open(file_path, "w", encoding="utf-8") as f:
+        with open_in(directory, data["filename"], "w", encoding="utf-8") as f:
             f.write(data.get("content", ""))
+        if directory == COMMAND_DIR:
+            index_command(data["filename"])
+            command_event.set()
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -86,15 +342,17 @@ def delete_file():
     
     if not directory:
         return jsonify({"success": False, "error": "Invalid directory type"})
+    if not is_safe_filename(data.get("filename")):
+        return jsonify({"success": False, "error": "Invalid filename"})
         
-    file_path = os.path.join(directory, data["filename"])
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    remove_file(directory, data["filename"])
+    if directory == COMMAND_DIR:
+        unindex_command(data["filename"])
     return jsonify({"success": True})
 
 @app.route("/list_commands", methods=["GET"])
 def list_commands():
-    """Lists all pending YAML commands."""
+    """Lists all pending YAML/JSON commands."""
     file_type = request.args.get("type")
     dir_path = get_target_dir(file_type)
     
@@ -102,16 +360,111 @@ def list_commands():
         return jsonify({"success": False, "error": "Unknown file type"})
 
     try:
-        files = [f for f in os.listdir(dir_path) if f.endswith(".yaml")]
+        # Commands are answered from the in-memory index; other folders are scanned
+        files = pending_commands() if dir_path == COMMAND_DIR else list_queue_files(dir_path)
+        return jsonify({"success": True, "files": files})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/wait_commands", methods=["GET"])
+def wait_commands():
+    """Long-polls for pending commands, blocking until one is saved or the timeout expires."""
+    try:
+        # Clear before scanning so a command saved in between still wakes us up
+        command_event.clear()
+        files = pending_commands()
+        if not files and command_event.wait(timeout=LONG_POLL_TIMEOUT):
+            files = pending_commands()
         return jsonify({"success": True, "files": files})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route("/claim_batch", methods=["GET"])
+def claim_batch():
+    """Long-polls for pending commands and claims up to N of them, returning their contents in one response."""
+    try:
+        limit = int(request.args.get("n", 32))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return jsonify({"success": False, "error": "Invalid batch size"})
+    limit = min(limit, MAX_BATCH_SIZE)
+
+    try:
+        requeue_inflight(max_age=INFLIGHT_LEASE)
+        # Clear before claiming so a command saved in between still wakes us up
+        command_event.clear()
+        files = claim_commands(limit)
+        if not files and command_event.wait(timeout=LONG_POLL_TIMEOUT):
+            files = claim_commands(limit)
+        return jsonify({"success": True, "files": files})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/finalize_batch", methods=["POST"])
+def finalize_batch():
+    """Saves the results of claimed commands and removes them from the inflight folder."""
+    data = request.json
+    try:
+        results = data.get("results", [])
+        if not all(is_safe_filename(item.get("filename")) for item in results):
+            return jsonify({"success": False, "error": "Invalid filename"})
+        for item in results:
+            # Entries without a result (e.g. corrupted commands) are only cleared
+            finalize_command(item["filename"], item.get("result"))
+        return jsonify({"success": True})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/finalize", methods=["POST"])
+def finalize():
+    """Saves the result of a single claimed command and clears the command in one request."""
+    data = request.json
+    if not is_safe_filename(data.get("filename")):
+        return jsonify({"success": False, "error": "Invalid filename"})
+    try:
+        finalize_command(data["filename"], data.get("result"))
+        return jsonify({"success": True})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/renew", methods=["POST"])
+def renew():
+    """Renews the lease of claimed commands the executor is still working on."""
+    data = request.json
+    try:
+        filenames = data.get("filenames", [])
+        if not all(is_safe_filename(name) for name in filenames):
+            return jsonify({"success": False, "error": "Invalid filename"})
+        for name in filenames:
+            try:
+                renew_claim(name)
+            except FileNotFoundError:
+                # Finalized in the meantime
+                continue
+        return jsonify({"success": True})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@app.route("/requeue", methods=["POST"])
+def requeue():
+    """Returns claimed commands the executor gave up on (e.g. while shutting down) to the queue."""
+    data = request.json
+    try:
+        filenames = data.get("filenames", [])
+        if not all(is_safe_filename(name) for name in filenames):
+            return jsonify({"success": False, "error": "Invalid filename"})
+        if any([requeue_command(name) for name in filenames]):
+            command_event.set()
+        return jsonify({"success": True})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
 @app.route("/list_results", methods=["GET"])
 def list_results():
     """Lists all available execution results."""
     try:
-        files = [f for f in os.listdir(RESULT_DIR) if f.endswith(".yaml")]
+        files = list_queue_files(RESULT_DIR, ".json")
         return jsonify({"success": True, "files": files})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
@@ -129,5 +482,9 @@ def serve_static_assets(path):
     return send_from_directory("static", path)
 
 if __name__ == "__main__":
+    # The built-in server is fine for personal use (and is the only option on Windows),
+    # but handles every request on a blocking thread. Queue state lives in this process,
+    # so production servers must run a single worker.
+    print("Tip: in production run `gunicorn -k gevent -w 1 --worker-connections 200 -b 0.0.0.0:8000 app:app`")
     # Listening on all interfaces for remote access
-    app.run(host="0.0.0.0", port=8000)
+    app.run(host="0.0.0.0", port=8000, threaded=True)
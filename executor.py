@@ -1,8 +1,27 @@
 import requests
+from requests.adapters import HTTPAdapter
+import orjson
 import yaml
 import time
 import subprocess
 import os
+import shutil
+import tempfile
+import threading
+import collections
+import hashlib
+
+# Prefer the libyaml-backed loader; fall back to pure Python if PyYAML was built without it
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Optional: BLAKE3 for hashing commands; the stdlib BLAKE2 is used when it isn't installed
+try:
+    from blake3 import blake3 as command_hasher
+except ImportError:
+    command_hasher = hashlib.blake2b
 
 # ===== Configuration =====
 # The address of the relay/task server
@@ -21,9 +40,72 @@ VENV_PYTHON = r"<your python.exe path>"
 # Path to the virtual environment's Pip tool.
 VENV_PIP = r"<your pip.exe path>"
 
+# Maximum number of commands claimed from the server per request
+BATCH_SIZE = 32
+
+# Number of tasks processed in parallel, so a slow pip install doesn't block quick file operations
+MAX_WORKERS = 8
+
+# Maximum number of child processes (pip/python) running at the same time; pip itself runs one at a time
+MAX_SUBPROCESSES = 2
+
+# Safety limit for file reads (5MB) to prevent memory exhaustion
+READ_LIMIT = 5 * 1024 * 1024
+
+# Number of files whose line offsets are memoized for ranged reads
+LINE_INDEX_CACHE_SIZE = 32
+
+# Number of recently processed commands (and their results) remembered to skip duplicate deliveries.
+# Results can hold up to READ_LIMIT of file content each, so keep this modest.
+DEDUP_CACHE_SIZE = 256
+
+# Seconds between lease renewals of claimed tasks. Renewals happen between long-polls
+# (up to 30s), so this plus the poll must stay below the server's INFLIGHT_LEASE (60s).
+LEASE_RENEW_INTERVAL = 15
+
 # Standard authorization headers
 HEADERS = {"Authorization": f"Bearer {TOKEN}"}
 
+# ===== HTTP Session =====
+# A shared session keeps connections to the server alive across polls and finalizations,
+# instead of paying a new TCP handshake for every request.
+# The pool is sized for the polling loop plus every worker finalizing at once.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * 2))
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * 2))
+
+# ===== Worker Pool =====
+# The polling loop appends claimed tasks to a deque and sets `tasks_ready`; MAX_WORKERS threads
+# pop from the other end. deque.append/popleft are atomic under the GIL, so no queue lock is needed.
+pending_tasks = collections.deque()
+tasks_ready = threading.Event()
+stop_workers = threading.Event()
+
+# On POSIX, close_fds=False lets subprocess start children with posix_spawn (vfork)
+# instead of fork+exec, so spawn cost doesn't grow with the executor's memory.
+# Python's own descriptors are non-inheritable (PEP 446), so nothing extra leaks.
+SPAWN_OPTIONS = {} if os.name == "nt" else {"close_fds": False}
+
+# Caps CPU-heavy subprocesses independently of the number of worker threads
+subprocess_slots = threading.BoundedSemaphore(MAX_SUBPROCESSES)
+
+# Filenames currently queued or running in a worker, to avoid dispatching the same task twice
+inflight_tasks = set()
+inflight_lock = threading.Lock()
+
+# Resources (target file paths, or "pip") with a task queued or running, each mapped to the
+# tasks waiting for it in claim order. Guarded by `inflight_lock`.
+busy_resources = {}
+
+# Results of recently processed commands by digest (insertion-ordered, oldest evicted first)
+seen_commands = collections.OrderedDict()
+seen_commands_lock = threading.Lock()
+
+# Memoized line offsets for ranged reads: abs_path -> ((inode, mtime, size), offsets, complete)
+line_index_cache = collections.OrderedDict()
+line_index_lock = threading.Lock()
+
 # ===== Utility Functions =====
 def run_pip(command, package):
     """
@@ -38,12 +120,15 @@ def run_pip(command, package):
             cmd_list.append("-y")
             
         # Execute the process with a 5-minute timeout
-        result = subprocess.run(
-            cmd_list,
-            capture_output=True, 
-            text=True, 
-            timeout=300
-        )
+        # pip commands share the "pip" resource, so only one ever runs at a time
+        with subprocess_slots:
+            result = subprocess.run(
+                cmd_list,
+                capture_output=True, 
+                text=True, 
+                timeout=300,
+                **SPAWN_OPTIONS
+            )
         
         # Return success with combined stdout and stderr for debugging
         return True, result.stdout + result.stderr
@@ -101,46 +186,108 @@ def update_file(file, range_str, content):
         except Exception as e:
             return False, f"Overwrite failed: {str(e)}"
 
-    # Read existing content
-    with open(abs_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-
     # Normalize input: split into lines and ensure each has a newline character
     new_lines = [line + "\n" for line in content.splitlines()]
 
-    # Append Mode: triggered if range_str is empty, "0", or "append"
+    # Append Mode: triggered if range_str is empty or "append"
+    # Only the new content is written; the existing file is never read in full
     if not range_str or range_str.lower() == "append":
         # Ensure the existing last line ends with a newline to prevent "sticking"
-        if lines and not lines[-1].endswith("\n"):
-            lines[-1] += "\n"
-        lines.extend(new_lines)
-        msg = "Content successfully appended to end of file."
+        needs_break = False
+        with open(abs_path, "rb") as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                needs_break = f.read(1) not in (b"\n", b"\r")
+        with open(abs_path, "a", encoding="utf-8") as f:
+            if needs_break:
+                f.write("\n")
+            f.writelines(new_lines)
+        return True, "Content successfully appended to end of file."
     
     # Range Mode: handles line replacement (e.g., "5-10") or single-line edits ("5")
-    else:
-        try: 
-            if "-" in range_str:
-                start, end = map(int, range_str.split("-"))
-            else:
-                # Support single line shorthand, e.g., "5"
-                start = end = int(range_str)
-
-            # Fix: Ensure the line before the update has a newline
-            if start > 1 and len(lines) >= start - 1:
-                if not lines[start-2].endswith("\n"):
-                    lines[start-2] += "\n"
-
-            # Python list slicing is start-inclusive and end-exclusive (0-based)
-            # lines[0:1] represents the first line in human terms.
-            lines[start-1:end] = new_lines
-            msg = f"Lines {start}-{end} updated."
-        except ValueError:
-            return False, "Invalid line range. Use 'start-end' or 'append'."
-
-    # Write the processed list back to the file
-    with open(abs_path, "w", encoding="utf-8") as f:
-        f.writelines(lines)
-    return True, msg
+    try: 
+        if "-" in range_str:
+            start, end = map(int, range_str.split("-"))
+        else:
+            # Support single line shorthand, e.g., "5"
+            start = end = int(range_str)
+        if start < 1:
+            raise ValueError("Line numbers start at 1")
+    except ValueError:
+        return False, "Invalid line range. Use 'start-end' or 'append'."
+
+    # Stream the file into a temp file next to it, then atomically swap it in.
+    # Lines after the range are copied in bulk without being split.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(abs_path))
+    try:
+        with open(abs_path, "r", encoding="utf-8") as src, os.fdopen(fd, "w", encoding="utf-8") as dst:
+            # 1. Copy the lines before the range
+            for _ in range(start - 1):
+                line = src.readline()
+                if not line:
+                    break
+                # Fix: Ensure the line before the update has a newline
+                if not line.endswith("\n"):
+                    line += "\n"
+                dst.write(line)
+
+            # 2. Write the new lines in place of lines start..end
+            dst.writelines(new_lines)
+            for _ in range(end - start + 1):
+                if not src.readline():
+                    break
+
+            # 3. Copy the remainder of the file unchanged
+            shutil.copyfileobj(src, dst)
+        shutil.copymode(abs_path, tmp_path)
+        os.replace(tmp_path, abs_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True, f"Lines {start}-{end} updated."
+
+def get_line_offsets(f, abs_path, end):
+    """
+    Returns the byte offsets where lines start in an open binary file, covering at least
+    `end` lines (or up to EOF / the read limit). offsets[i] is where line i+1 begins.
+    Offsets are memoized per file and reused until its (inode, mtime, size) changes, so
+    repeated ranged reads only scan the part of the file they have not seen yet.
+    """
+    st = os.fstat(f.fileno())
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    with line_index_lock:
+        cached = line_index_cache.get(abs_path)
+        if cached and cached[0] == key:
+            line_index_cache.move_to_end(abs_path)
+            offsets, complete = cached[1], cached[2]
+        else:
+            offsets, complete = [0], False
+
+    if complete or len(offsets) > end:
+        return offsets
+
+    # Extend the index from the last known line start
+    offsets = offsets[:]
+    pos = offsets[-1]
+    f.seek(pos)
+    while len(offsets) <= end:
+        line = f.readline(READ_LIMIT - pos)
+        if not line:
+            complete = True
+            break
+        pos += len(line)
+        offsets.append(pos)
+        if pos >= READ_LIMIT:
+            complete = True
+            break
+
+    with line_index_lock:
+        line_index_cache[abs_path] = (key, offsets, complete)
+        line_index_cache.move_to_end(abs_path)
+        while len(line_index_cache) > LINE_INDEX_CACHE_SIZE:
+            line_index_cache.popitem(last=False)
+    return offsets
 
 def read_file(file, range_str=None):
     """
@@ -157,30 +304,51 @@ def read_file(file, range_str=None):
             # 2. Safety Limit: Read up to 5MB to prevent memory exhaustion (OOM)
             # 5MB covers almost any source code while keeping the response snappy
             if not range_str:
-                raw_data = f.read(5 * 1024 * 1024) 
+                raw_data = f.read(READ_LIMIT) 
                 # Decode with errors="ignore" to ensure the process never crashes on binary data
                 return True, raw_data.decode("utf-8", errors="ignore")
             
             # 3. Line Range Reading
-            # We read the first 5MB and then process line slices
-            f.seek(0)  # Reset to beginning of file
-            content = f.read(5 * 1024 * 1024).decode("utf-8", errors="ignore")
-            line_list = content.splitlines(keepends=True)
-            
             try:
                 if "-" in range_str:
                     start, end = map(int, range_str.split("-"))
                 else:
                     start = end = int(range_str)
-                
-                # Python slicing is safe even if indices are out of range
-                return True, "".join(line_list[start-1:end])
+                if start < 1:
+                    raise ValueError("Line numbers start at 1")
             except ValueError:
                 return False, "Invalid range format. Use 'start-end'."
 
+            # Only the file up to line `end` is scanned, then the range is read with a single seek
+            offsets = get_line_offsets(f, abs_path, end)
+            last_line = len(offsets) - 1
+            first, last = min(start - 1, last_line), min(end, last_line)
+            if last <= first:
+                return True, ""
+            f.seek(offsets[first])
+            return True, f.read(offsets[last] - offsets[first]).decode("utf-8", errors="ignore")
+
     except Exception as e:
         return False, f"Read error: {str(e)}"
 
+def iter_files(directory):
+    """
+    Recursively yields the paths of all files under a directory (same entries as os.walk).
+    Uses os.scandir so file/dir checks come from the cached d_type instead of extra stat calls.
+    """
+    try:
+        it = os.scandir(directory)
+    except OSError:
+        # Skip unreadable directories, like os.walk does
+        return
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif not entry.is_symlink() or not entry.is_dir():
+                # Symlinked directories are neither descended into nor listed
+                yield entry.path
+
 def compile_file_unused(file, output):
     """
     Note: This is a legacy function and is not integrated into the current task executor.
@@ -212,12 +380,14 @@ def execute_file(file, args=""):
         cmd = [VENV_PYTHON, abs_path] + args.split()
         
         # Execute the script with a 5-minute (300s) timeout protection
-        result = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True, 
-            timeout=300
-        )
+        with subprocess_slots:
+            result = subprocess.run(
+                cmd, 
+                capture_output=True, 
+                text=True, 
+                timeout=300,
+                **SPAWN_OPTIONS
+            )
         
         # Return both stdout and stderr for remote debugging
         return True, {
@@ -229,149 +399,309 @@ def execute_file(file, args=""):
     except Exception as e:
         return False, f"Execution error: {str(e)}"
        
+# ===== Action Handlers =====
+# Each handler receives the parsed command and returns its result dictionary.
+def action_install_pip(config):
+    success, msg = run_pip("install", config["package"])
+    return {"success": success, "message": msg}
+
+def action_uninstall_pip(config):
+    success, msg = run_pip("uninstall", config["package"])
+    return {"success": success, "message": msg}
+
+def action_create_file(config):
+    success, msg = create_file(config["file"], config.get("content",""))
+    return {"success": success, "message": msg}
+
+def action_delete_file(config):
+    success, msg = delete_file(config["file"])
+    return {"success": success, "message": msg}
+
+def action_update_file(config):
+    success, msg = update_file(config["file"], config["range"], config.get("content",""))
+    return {"success": success, "message": msg}
+
+def action_read_file(config):
+    success, content = read_file(config["file"], config.get("range"))
+    return {"success": success, "content": content}
+
+def action_execute(config):
+    success, output = execute_file(config["file"], config.get("args", ""))
+    result = {"success": success}
+    if success: result.update(output)
+    else: result["error"] = output
+    return result
+
+def action_list_executor_dir(config):
+    file_list = [os.path.relpath(path, BASE_DIR) for path in iter_files(BASE_DIR)]
+    return {"success": True, "files": file_list}
+
+# Action name -> (handler, error prefix reported when the handler raises)
+ACTIONS = {
+    "install_pip": (action_install_pip, "Pip install error"),
+    "uninstall_pip": (action_uninstall_pip, "Pip uninstall error"),
+    "create_file": (action_create_file, "Create file error"),
+    "delete_file": (action_delete_file, "Delete file error"),
+    "update_file": (action_update_file, "Update file error"),
+    "read_file": (action_read_file, "Read file error"),
+    "execute": (action_execute, "Execution error"),
+    "list_executor_dir": (action_list_executor_dir, "Directory listing error"),
+}
+
 # ===== Task Dispatcher =====
-def process_command_file(filename):
+def command_digest(filename, yaml_content):
     """
-    Fetches and dispatches commands. 
-    Each action is wrapped in a try-except block to ensure that a single 
-    KeyError or parameter issue doesn't break the entire cleanup loop.
+    Hashes a command's name together with its content.
+    Task names embed a timestamp, so equal digests only match re-deliveries of the same
+    task (failed finalization, requeue after a server restart), never a user
+    deliberately repeating an action.
     """
-    # 1. Fetch & Parse YAML
-    try:
-        r = requests.get(f"{SERVER}/read_file", params={"type":"command", "filename": filename}, headers=HEADERS)
-        if not r.ok: return
-        
-        yaml_content = r.json().get("content", "")
-        try:
-            config = yaml.safe_load(yaml_content)
-            if not config: raise ValueError("Empty YAML payload")
-        except Exception as yaml_err:
-            # If YAML is unreadable, delete it directly to unblock the queue
-            print(f"Skipping corrupted YAML {filename}: {yaml_err}")
-            requests.post(f"{SERVER}/delete_file", json={"type":"command","filename":filename}, headers=HEADERS)
-            return
-            
-        # --- Pre-validation Check ---
-        action = config.get("action")
-        if not action:
-            result = {"success": False, "error": "Missing 'action' attribute in YAML"}
-            # Jump to finalization to cleanup this invalid command
-            finalize_task(filename, result)
-            return
-        result = {"success": False} # Default to False unless successful
-
-        # 2. Action Dispatching with Individual "Bulletproof" Wrappers
-        # Each block is isolated to catch missing keys (KeyError) or invalid arguments
-        if action == "install_pip":
-            try:
-                success, msg = run_pip("install", config["package"])
-                result = {"success": success, "message": msg}
-            except Exception as e:
-                result["error"] = f"Pip install error: {str(e)}"
-
-        elif action == "uninstall_pip":
-            try:
-                success, msg = run_pip("uninstall", config["package"])
-                result = {"success": success, "message": msg}
-            except Exception as e:
-                result["error"] = f"Pip uninstall error: {str(e)}"
-
-        elif action == "create_file":
-            try:
-                success, msg = create_file(config["file"], config.get("content",""))
-                result = {"success": success, "message": msg}
-            except Exception as e:
-                result["error"] = f"Create file error: {str(e)}"
-
-        elif action == "delete_file":
-            try:
-                success, msg = delete_file(config["file"])
-                result = {"success": success, "message": msg}
-            except Exception as e:
-                result["error"] = f"Delete file error: {str(e)}"
-
-        elif action == "update_file":
-            try:
-                success, msg = update_file(config["file"], config["range"], config.get("content",""))
-                result = {"success": success, "message": msg}
-            except Exception as e:
-                result["error"] = f"Update file error: {str(e)}"
-
-        elif action == "read_file":
-            try:
-                success, content = read_file(config["file"], config.get("range"))
-                result = {"success": success, "content": content}
-            except Exception as e:
-                result["error"] = f"Read file error: {str(e)}"
-
-        elif action == "execute":
-            try:
-                success, output = execute_file(config["file"], config.get("args", ""))
-                result = {"success": success}
-                if success: result.update(output)
-                else: result["error"] = output
-            except Exception as e:
-                result["error"] = f"Execution error: {str(e)}"
-
-        elif action == "list_executor_dir":
-            try:
-                file_list = []
-                for root, dirs, files in os.walk(BASE_DIR):
-                    for f in files:
-                        rel_path = os.path.relpath(os.path.join(root,f), BASE_DIR)
-                        file_list.append(rel_path)
-                result = {"success": True, "files": file_list}
-            except Exception as e:
-                result["error"] = f"Directory listing error: {str(e)}"
+    return command_hasher(f"{filename}\0{yaml_content}".encode("utf-8")).digest()
 
+def processed_result(digest):
+    """
+    Returns `(True, result)` if a command with this digest was already processed recently,
+    `(False, None)` otherwise. The result itself is None for corrupted commands.
+    """
+    with seen_commands_lock:
+        if digest in seen_commands:
+            seen_commands.move_to_end(digest)
+            return True, seen_commands[digest]
+    return False, None
+
+def remember_command(digest, result):
+    """Records a processed command's result, evicting the oldest beyond DEDUP_CACHE_SIZE."""
+    with seen_commands_lock:
+        seen_commands[digest] = result
+        while len(seen_commands) > DEDUP_CACHE_SIZE:
+            seen_commands.popitem(last=False)
+
+def parse_command(filename, yaml_content):
+    """Parses a claimed command, returning None if it is corrupted."""
+    try:
+        # JSON commands skip the YAML parser entirely
+        if filename.endswith(".json"):
+            config = orjson.loads(yaml_content)
         else:
-            result["error"] = f"Unknown action: {action}"
-
-    except Exception as network_e:
-        print(f"Network error: {network_e}")
-        return
-
-    # 3. Finalization: Ensures corrupted/finished tasks are always cleared
-    finalize_task(filename, result)
+            config = yaml.load(yaml_content, Loader=SafeLoader)
+        if not config: raise ValueError("Empty YAML payload")
+        return config
+    except Exception as yaml_err:
+        print(f"Skipping corrupted YAML {filename}: {yaml_err}")
+        return None
+
+def task_resource(config):
+    """
+    Returns the resource a command works on: the target file's absolute path, or "pip" for
+    package actions. Commands on the same resource run one at a time, in claim order.
+    """
+    if not isinstance(config, dict):
+        return None
+    # Two pip processes must never modify the virtual environment at once
+    if config.get("action") in ("install_pip", "uninstall_pip"):
+        return "pip"
+    file = config.get("file")
+    if isinstance(file, str):
+        return os.path.normcase(os.path.abspath(os.path.join(BASE_DIR, file)))
+    return None
+
+def process_command_file(filename, yaml_content, config):
+    """
+    Dispatches a claimed command that was parsed at claim time, returning its result.
+    The handler call is wrapped in a try-except block to ensure that a single 
+    KeyError or parameter issue doesn't break the entire cleanup loop.
+    Returns None for corrupted commands, which are dropped without a result.
+    """
+    # 1. If YAML was unreadable, drop it directly to unblock the queue
+    if config is None:
+        return None
+        
+    # --- Pre-validation Check ---
+    action = config.get("action")
+    if not action:
+        # Return early so this invalid command still gets cleaned up
+        return {"success": False, "error": "Missing 'action' attribute in YAML"}
+
+    # 2. Action Dispatching with a "Bulletproof" Wrapper
+    # Any exception raised by a handler (e.g. a missing key) becomes this task's error
+    entry = ACTIONS.get(action)
+    if not entry:
+        return {"success": False, "error": f"Unknown action: {action}"}
+    handler, error_label = entry
+    try:
+        return handler(config)
+    except Exception as e:
+        return {"success": False, "error": f"{error_label}: {str(e)}"}
 
 def finalize_task(filename, result):
-    """Helper to upload results and delete the command file."""
+    """
+    Uploads a task's result and clears its command file in a single request.
+    The result is sent as a JSON object; the server stores it as JSON, no YAML round-trip.
+    """
+    payload = {"filename": filename}
+    # A None result (corrupted command) only clears the command
+    if result is not None:
+        payload["result"] = result
     try:
-        requests.post(f"{SERVER}/save_file", json={"type":"result","filename":filename,"content":yaml.safe_dump(result)}, headers=HEADERS)
-        requests.post(f"{SERVER}/delete_file", json={"type":"command","filename":filename}, headers=HEADERS)
+        SESSION.post(f"{SERVER}/finalize", data=orjson.dumps(payload), headers={"Content-Type": "application/json"})
     except Exception as e:
         print(f"Finalization failed for {filename}: {e}")
 
+def dispatch_task(filename, yaml_content):
+    """
+    Queues a claimed command for the workers. A command whose resource is busy waits
+    behind the earlier ones instead, so edits to one file never race each other.
+    """
+    with inflight_lock:
+        if filename in inflight_tasks:
+            return
+        inflight_tasks.add(filename)
+
+    config = parse_command(filename, yaml_content)
+    task = (task_resource(config), filename, yaml_content, config)
+
+    with inflight_lock:
+        resource = task[0]
+        if resource is not None:
+            if resource in busy_resources:
+                busy_resources[resource].append(task)
+                return
+            busy_resources[resource] = collections.deque()
+    pending_tasks.append(task)
+    tasks_ready.set()
+
+def release_resource(resource):
+    """Hands a freed resource to the next task waiting for it, if any."""
+    if resource is None:
+        return
+    with inflight_lock:
+        waiting = busy_resources[resource]
+        if not waiting:
+            del busy_resources[resource]
+            return
+        # Queued under the lock, so shutdown_workers() can't miss it
+        pending_tasks.append(waiting.popleft())
+    tasks_ready.set()
+
+def run_task(resource, filename, yaml_content, config):
+    """Worker entry point: processes a single claimed command and finalizes it right away."""
+    digest = command_digest(filename, yaml_content)
+    try:
+        # Idempotency: a re-delivered command is not run again; the first run's result is
+        # sent again instead, since it may never have reached the server
+        processed, result = processed_result(digest)
+        if processed:
+            print(f"Skipping duplicate command {filename}")
+            if result is not None:
+                result = {**result, "deduplicated": True}
+            finalize_task(filename, result)
+            return
+        try:
+            result = process_command_file(filename, yaml_content, config)
+        except Exception as e:
+            print(f"[ERROR] Critical failure while processing {filename}: {e}")
+            result = {"success": False, "error": f"Critical failure: {str(e)}"}
+        # Recorded once the command has run, and before it leaves inflight_tasks
+        remember_command(digest, result)
+        finalize_task(filename, result)
+    finally:
+        with inflight_lock:
+            inflight_tasks.discard(filename)
+        release_resource(resource)
+
+def worker_loop():
+    """Worker thread: runs pending tasks until the executor is stopped."""
+    while True:
+        tasks_ready.wait()
+        if stop_workers.is_set():
+            return
+        try:
+            task = pending_tasks.popleft()
+        except IndexError:
+            tasks_ready.clear()
+            # Re-check: a task appended between popleft() and clear() would otherwise sleep unnoticed
+            if pending_tasks:
+                tasks_ready.set()
+            continue
+        run_task(*task)
+
+def start_workers():
+    """Starts the worker threads that drain `pending_tasks`."""
+    for i in range(MAX_WORKERS):
+        threading.Thread(target=worker_loop, name=f"worker-{i}").start()
+
+def shutdown_workers():
+    """
+    Stops the workers and hands tasks that haven't started back to the server's queue.
+    Running tasks finish and are finalized; idle workers exit immediately.
+    """
+    stop_workers.set()
+    tasks_ready.set()
+
+    with inflight_lock:
+        dropped = []
+        while pending_tasks:
+            dropped.append(pending_tasks.popleft())
+        for waiting in busy_resources.values():
+            dropped.extend(waiting)
+            waiting.clear()
+        filenames = [filename for _, filename, _, _ in dropped]
+        inflight_tasks.difference_update(filenames)
+
+    if filenames:
+        try:
+            SESSION.post(f"{SERVER}/requeue", data=orjson.dumps({"filenames": filenames}), headers={"Content-Type": "application/json"}, timeout=5)
+        except Exception as e:
+            # The server's inflight lease will requeue them instead
+            print(f"Failed to requeue {len(filenames)} unstarted task(s): {e}")
+
+def renew_claims():
+    """Renews the server-side lease of every claimed task that hasn't been finalized yet."""
+    with inflight_lock:
+        filenames = list(inflight_tasks)
+    if filenames:
+        SESSION.post(f"{SERVER}/renew", data=orjson.dumps({"filenames": filenames}), headers={"Content-Type": "application/json"}, timeout=10)
+
 # ===== Main Polling Loop =====
 def main_loop():
     """
-    Main execution loop that polls the remote server for new commands.
+    Main execution loop that long-polls the remote server for new commands.
     """
     print(f"Executor started. Monitoring server at: {SERVER}")
     print("Base directory:", os.path.abspath(BASE_DIR))
+    start_workers()
+    last_renewal = time.monotonic()
 
     while True:
         try:
-            # 1. Fetch the list of pending command files from the server
-            # We use a 10s timeout to prevent the loop from hanging on network issues
-            r = requests.get(
-                f"{SERVER}/list_commands", 
-                params={"type": "command"}, 
-                headers=HEADERS, 
-                timeout=10
+            # Keep the server from handing out tasks that are still queued or running here
+            if time.monotonic() - last_renewal >= LEASE_RENEW_INTERVAL:
+                renew_claims()
+                last_renewal = time.monotonic()
+
+            # 1. Long-poll the server to claim a batch of pending commands
+            # The server holds the request open until a command arrives (max 30s),
+            # so the read timeout must be longer than the server-side wait
+            r = SESSION.get(
+                f"{SERVER}/claim_batch", 
+                params={"n": BATCH_SIZE}, 
+                timeout=35
             )
             
             if r.ok:
-                files = r.json().get("files", [])
-                if files:
-                    print(f"Found {len(files)} new task(s). Processing...")
-                
-                for filename in files:
-                    try:
-                        # Dispatch each task to the processor
-                        process_command_file(filename)
-                    except Exception as e:
-                        print(f"[ERROR] Critical failure while processing {filename}: {e}")
+                data = orjson.loads(r.content)
+                if data.get("success"):
+                    tasks = data.get("files", [])
+                    if tasks:
+                        print(f"Found {len(tasks)} new task(s). Processing...")
+                    
+                    # 2. Hand the claimed commands to the workers; each worker finalizes its own task
+                    for task in tasks:
+                        dispatch_task(task["name"], task["content"])
+                    # The server already waited for commands, so poll again right away
+                    continue
+                # Server-side errors return immediately; fall through to the backoff
+                print(f"[WARNING] Server failed to hand out commands: {data.get('error')}")
             else:
                 print(f"[WARNING] Failed to fetch command list. Status Code: {r.status_code}")
         
@@ -379,7 +709,7 @@ def main_loop():
             # Catching connection errors, timeouts, etc.
             print(f"[NETWORK ERROR] Server unreachable: {e}")
 
-        # Polling interval to prevent CPU/Network exhaustion
+        # Back off after a failed request to prevent CPU/Network exhaustion
         time.sleep(1)
 
 if __name__ == "__main__":
@@ -387,3 +717,6 @@ if __name__ == "__main__":
         main_loop()
     except KeyboardInterrupt:
         print("\nExecutor stopped by user.")
+    finally:
+        # Always stop the non-daemon workers, so an unexpected error still exits the process
+        shutdown_workers()